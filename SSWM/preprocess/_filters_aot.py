@@ -0,0 +1,32 @@
+"""
+Ahead-of-time compilation of the speckle filter kernels in filters.py
+
+Build the native module once at install time with:
+
+    python -m SSWM.preprocess._filters_aot
+
+This writes a _filters_native extension module next to this file. The
+AOT-compiled kernels are serial, so filters.py only uses them when Numba's JIT
+compilation is disabled (NUMBA_DISABLE_JIT=1), where the kernels would otherwise
+run as pure Python. By default the parallel JIT kernels are used; they are
+cached on disk, so only the first process on a machine pays for compilation.
+"""
+
+import os
+
+from numba.pycc import CC
+
+from SSWM.preprocess import filters
+
+cc = CC('_filters_native')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('elee_kernel', 'void(f4[:,:,:], f4[:,:,:], f4[:,:,:], f4, f4, f4, f4[:,:,:])')(
+    filters._elee_combine.py_func)
+cc.export('box_sum_cols', 'void(f4[:,:,:], i8, b1, f4[:,:,:])')(
+    filters._box_sum_cols.py_func)
+cc.export('box_sum_rows', 'void(f4[:,:,:], i8, f8, f4[:,:,:])')(
+    filters._box_sum_rows.py_func)
+
+if __name__ == "__main__":
+    cc.compile()
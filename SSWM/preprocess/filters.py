@@ -2,13 +2,31 @@
 # Filters
 #
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from osgeo import gdal
+import inspect
+import math
 import numpy as np
+import os
 
-from scipy.ndimage.filters import uniform_filter
-from scipy.ndimage.measurements import variance, label
+from scipy import LowLevelCallable
+from scipy.ndimage import correlate, generic_filter, variance
+from scipy.signal import oaconvolve
+import numba
+from numba import cfunc, carray, njit, prange
 from SSWM.preprocess.preutils import cloneRaster
 
+# kernels compiled ahead of time by _filters_aot.py, if they have been built.
+# They are serial, so they only replace the parallel JIT kernels when JIT
+# compilation is disabled (NUMBA_DISABLE_JIT=1).
+_filters_native = None
+if numba.config.DISABLE_JIT:
+    try:
+        from SSWM.preprocess import _filters_native
+    except ImportError:
+        pass
+
 
 # https://stackoverflow.com/questions/4959171/improving-memory-usage-in-an-array-wide-filter-to-avoid-block-processing
 
@@ -33,22 +51,15 @@ def lee_filter2(img, window = (3,3)):
     
     array 
         filtered array
-    """
     
-    img_mean = uniform_filter(img, window)
-    img_sqr = np.square(img)
-    
-    img_sqr_mean = uniform_filter(img_sqr, window)
-    img_variance = img_sqr_mean - img_mean**2
-
-    overall_variance = variance(img)
-
-    img_weights = img_variance / (img_variance + overall_variance)
-    img_output = img_mean + img_weights * (img - img_mean)
+    Equivalent to ``lee_filter`` except that the overall variance includes
+    zero-valued pixels.
+    """
     
-    return img_output
+    return lee_filter(img, window, overall_variance=np.float32(variance(img)))
     
-def lee_filter(img, window = (5,5)):
+def lee_filter(img, window = (5,5), overall_variance=None, out=None,
+               mean_out=None, variance_out=None):
     """ Apply a Lee filter to a numpy array. Modifies original array
      
     *Parameters*
@@ -57,32 +68,123 @@ def lee_filter(img, window = (5,5)):
         Array to which filter is applied
     window : int
         Size of filter
+    overall_variance : float or numpy array, optional
+        Variance of the (nonzero) image. If not provided, it is computed from
+        ``img``. Supply it when ``img`` is only a tile of a larger image. For a
+        3-D stack of bands, an array with shape (bands, 1, 1).
+    out : numpy array, optional
+        float32 array with the same shape as ``img`` into which the result is
+        written
+    mean_out, variance_out : numpy array, optional
+        float32 arrays with the same shape as ``img`` used as scratch for the
+        moving window mean and variance, so that repeated calls can reuse them
     
     """
-    d = np.array(img, dtype='float32')
-    img_variance, img_mean = moving_window_sd(d, window, return_mean=True, return_variance=True)
-    
-    lbl, nlbl = label(d)
-    overall_variance = variance(d, lbl)
+    if out is None:
+        d = np.array(img, dtype='float32')
+    else:
+        d = out
+        np.copyto(d, img, casting='unsafe')
+    img_variance, img_mean = moving_window_sd(d, window, return_mean=True, return_variance=True,
+                                              out=variance_out, mean_out=mean_out)
     
-    # set overall = overall_var + img_var
-    overall_variance = np.add(overall_variance, img_variance) 
+    if overall_variance is None and d.ndim == 3:
+        overall_variance = np.array([image_variance(b) for b in d], dtype=np.float32)[:, None, None]
+    elif overall_variance is None:
+        overall_variance = image_variance(d)
     
     # set d = img - img_mean
     np.subtract(d, img_mean, out=d)
     
-    # set  img_variance = img_variance / overall_var + img_var = weights
-    np.divide(img_variance, overall_variance, out=img_variance)
-    del overall_variance
-    
-    # set d = weights * img - img_mean
+    # set d = img_var * (img - img_mean)
     np.multiply(img_variance, d, out=d)
     
+    # set img_variance = img_var + overall_var
+    np.add(img_variance, overall_variance, out=img_variance)
+    
+    # set d = weights * (img - img_mean)
+    np.divide(d, img_variance, out=d)
+    
     np.add(img_mean, d, out=d) # d = img_mean + weights * img - img_mean
 
     return d
     
-def enhanced_lee_filter(img , looks, window=7, df=1):
+def image_variance(img):
+    """ Variance of the nonzero pixels of an image
+    
+    *Parameters*
+    
+    img : numpy array  
+        Array for which variance is calculated
+    
+    *Returns*
+    
+    float
+    """
+    n, mean, ss = _nonzero_moments(img)
+    return ss / n if n else np.nan
+
+def band_variance(band, rows=None):
+    """ Variance of the nonzero pixels of a raster band, read in strips
+    
+    *Parameters*
+    
+    band : gdal.Band
+        Raster band for which variance is calculated
+    rows : int, optional
+        Number of rows read at a time. Defaults to a multiple of the band's
+        block height.
+    
+    *Returns*
+    
+    float
+    """
+    H, W = band.YSize, band.XSize
+    rows = rows or _strip_rows(band)
+    
+    buf = np.empty((min(rows, H), W), dtype=np.float32)
+    
+    # combine strip moments following Chan et al. (1979)
+    n, mean, ss = 0, 0.0, 0.0
+    for y in range(0, H, rows):
+        strip = buf[:min(rows, H - y)]
+        band.ReadAsArray(0, y, W, strip.shape[0], buf_obj=strip)
+        n_s, mean_s, ss_s = _nonzero_moments(strip)
+        if n_s == 0:
+            continue
+        delta = mean_s - mean
+        total = n + n_s
+        mean += delta * n_s / total
+        ss += ss_s + delta ** 2 * n * n_s / total
+        n = total
+    
+    return ss / n if n else np.nan
+
+@njit(parallel=True, nogil=True, cache=True)
+def _nonzero_moments(img):
+    """ Count, mean and sum of squared deviations of the nonzero values of a 2-D array """
+    H, W = img.shape
+    n = 0
+    total = 0.0
+    for i in prange(H):
+        for j in range(W):
+            if img[i, j] != 0:
+                n += 1
+                total += img[i, j]
+    
+    if n == 0:
+        return 0, 0.0, 0.0
+    mean = total / n
+    
+    ss = 0.0
+    for i in prange(H):
+        for j in range(W):
+            if img[i, j] != 0:
+                ss += (img[i, j] - mean) ** 2
+    
+    return n, mean, ss
+    
+def enhanced_lee_filter(img , looks, window=7, df=1, out=None, mean_out=None):
     """ Apply enhanced lee filter to image.  Does not modify original.
     
     Enhanced lee filter following Lopes et al. (1990) (PCI implementation)
@@ -98,6 +200,12 @@ def enhanced_lee_filter(img , looks, window=7, df=1):
         Number of looks in input image
     df : int
         Number of degrees of freedom
+    out : numpy array, optional
+        float32 array with the same shape as ``img`` into which the result is
+        written
+    mean_out : numpy array, optional
+        float32 array with the same shape as ``img`` used as scratch for the
+        moving window mean, so that repeated calls can reuse it
 
     *Returns*
     
@@ -118,54 +226,79 @@ def enhanced_lee_filter(img , looks, window=7, df=1):
     
     """
     
-    img = np.array(img, dtype=np.float32) # convert from int to avoid numeric overflow 
-    Cu = np.sqrt(1 / looks)
-    Cmax = np.sqrt(1 + 2 / looks)
+    img = np.asarray(img, dtype=np.float32) # convert from int to avoid numeric overflow 
+    looks = np.float32(looks)
+    Cu = np.sqrt(np.float32(1) / looks)
+    Cmax = np.sqrt(np.float32(1) + np.float32(2) / looks)
 
-    Ic = np.copy(img) # copy so we don't modify the original
-    Im = uniform_filter(img, window)
-    S = window_stdev(img, window, Im)
-    Ci = S / Im
+    # S is computed directly into the output array; _elee_combine reads S at
+    # each pixel before overwriting it with R
+    R = np.empty_like(img) if out is None else out
+    S, Im = moving_window_sd(img, window, return_mean=True, out=R, mean_out=mean_out)
     
-    # Do R2 first so that Im and Ic can then be modified in-place
-    # Also mask any W calculations that aren't in (Cu < Ci < Cmax) case because 
-    # for (Cmax - Ci) << 1, np.exp will return overflow errors.
-    M2 = np.less(Cu, Ci) * np.less(Ci, Cmax)
-    W = np.exp((-df * (Ci - Cu)/(Cmax - Ci)) * M2)
-    R2 = (Im * W + Ic * (1-W)) * M2
-    
-    M1 = np.less_equal(Ci, Cu)
-    Im *= M1
-    
-    M3 = np.greater_equal(Ci, Cu)
-    Ic *= M3
-    
-    R = Im + R2 + Ic
+    combine = _elee_combine if _filters_native is None else _filters_native.elee_kernel
+    combine(_as_stack(img), _as_stack(Im), _as_stack(S), Cu, Cmax, np.float32(df),
+            _as_stack(R))
     
     return(R)
 
-def moving_window_sd(data, window, return_mean=False, return_variance=False):
+@njit("void(f4[:,:,:], f4[:,:,:], f4[:,:,:], f4, f4, f4, f4[:,:,:])",
+      parallel=True, fastmath=True, nogil=True, cache=True)
+def _elee_combine(img, Im, S, Cu, Cmax, df, out):
+    """ Combine kernel statistics into the enhanced lee filter output
+    
+    Evaluates the three cases described in ``enhanced_lee_filter`` in a single
+    pass over the image, writing the result to ``out``. The cases are selected
+    by comparing S against Cu * Im and Cmax * Im (i.e. Ci against Cu and Cmax)
+    so the damping weight W is only computed for Cu < Ci < Cmax, where it cannot
+    overflow. Using (Ci - Cu) / (Cmax - Ci) = (S - Cu * Im) / (Cmax * Im - S)
+    keeps the denominator strictly positive. All arithmetic is single precision.
+    
+    Arrays are stacks of 2-D arrays with shape (bands, rows, columns). Each pixel
+    is read before it is written, so ``out`` may be the same array as ``S``.
+    """
+    one = numba.float32(1)
+    B, H, W = img.shape
+    for t in prange(B * H):
+        b, i = t // H, t % H
+        for j in range(W):
+            lower = Cu * Im[b, i, j]
+            upper = Cmax * Im[b, i, j]
+            
+            if Im[b, i, j] <= 0: # empty (nodata) kernel, Ci is undefined
+                out[b, i, j] = img[b, i, j]
+            elif S[b, i, j] <= lower:
+                out[b, i, j] = Im[b, i, j]
+            elif S[b, i, j] < upper:
+                Wt = math.exp(-df * (S[b, i, j] - lower) / (upper - S[b, i, j]))
+                out[b, i, j] = Im[b, i, j] * Wt + img[b, i, j] * (one - Wt)
+            else:
+                out[b, i, j] = img[b, i, j]
+
+def moving_window_sd(data, window, return_mean=False, return_variance=False,
+                     out=None, mean_out=None):
     """
     This is Ben's implementation
     Calculate a moving window standard deviation (and mean)
-    """
     
-    t1 = data.copy()
-    t2 = np.square(t1)
-    
-    uniform_filter(t1, window, output=t1)
-    uniform_filter(t2, window, output=t2)
+    ``out`` and ``mean_out`` are optional float32 arrays with the same shape as
+    ``data`` into which the standard deviation (or variance) and mean are
+    written, so that repeated calls can reuse the same buffers.
+    """
     
-    if return_mean:
-        m = t1.copy()
-        
-    np.square(t1, out=t1)
-    np.subtract(t2, t1, out=t2)
-    t2[t2 < 0] = 0
-    del t1
+    m = np.empty(data.shape, dtype=np.float32) if mean_out is None else mean_out
+    t2 = np.empty_like(m) if out is None else out
+    footprint = _footprint(window, data.ndim)
     
-    if not return_variance:
-        np.sqrt(t2, out=t2)
+    if footprint is None or _large_footprint(footprint):
+        _window_mean_var(data, window, m, t2)
+        if not return_variance:
+            np.sqrt(t2, out=t2)
+    else:
+        if return_mean:
+            _uniform_filter(data, footprint, m)
+        kernel = _WINDOW_VARIANCE if return_variance else _WINDOW_STDEV
+        generic_filter(data, kernel, footprint=footprint, output=t2)
 
     if return_mean:
         return t2, m
@@ -179,8 +312,8 @@ def window_stdev(img, window, img_mean=None, img_sqr_mean=None):
     
     img : numpy array  
         Array to which filter is applied
-    window : int
-        Size of filter
+    window : int, tuple or numpy array
+        Size of filter, or a boolean footprint for non-rectangular windows
     img_mean : array, optional
         Mean of image calculated using an equally sized window. 
         If not provided, it is computed.
@@ -192,14 +325,351 @@ def window_stdev(img, window, img_mean=None, img_sqr_mean=None):
     http://nickc1.github.io/python,/matlab/2016/05/17/Standard-Deviation-(Filters)-in-Matlab-and-Python.html
     """
     
+    footprint = _footprint(window, img.ndim)
+    if footprint is not None and not _large_footprint(footprint):
+        return generic_filter(img, _WINDOW_STDEV, footprint=footprint,
+                              output=np.empty(img.shape, dtype=np.float32))
+    
     if img_mean is None:
-        img_mean = uniform_filter(img, window)
+        img_mean = _uniform_filter(img, window, np.empty(img.shape, dtype=np.float32))
     if img_sqr_mean is None:
-        img_sqr_mean = uniform_filter(img**2, window)
+        img_sqr_mean = _uniform_filter(img, window, np.empty(img.shape, dtype=np.float32), square=True)
     std = np.sqrt(img_sqr_mean - img_mean**2)
     
     return(std)
+
+def _window_shape(window):
+    """ Return filter window size as a (rows, columns) tuple """
+    if np.ndim(window) == 0:
+        return (int(window), int(window))
+    if np.ndim(window) >= 2: # footprint
+        return np.shape(window)[-2:]
+    return tuple(int(w) for w in window)
+
+def _footprint(window, ndim=2):
+    """ Return window as a boolean footprint, or None if it is rectangular
+    
+    The footprint is given ``ndim`` dimensions so it can be applied to each band
+    of a stack of arrays.
+    """
+    if np.ndim(window) >= 2:
+        footprint = np.asarray(window, dtype=bool)
+        if not footprint.all():
+            return footprint.reshape((1,) * (ndim - footprint.ndim) + footprint.shape)
+    return None
+
+@njit(cache=True)
+def _values_variance(values):
+    """ Two-pass variance of a 1-D array """
+    n = values.shape[0]
+    mean = 0.0
+    for k in range(n):
+        mean += values[k]
+    mean /= n
+    
+    ss = 0.0
+    for k in range(n):
+        ss += (values[k] - mean) ** 2
+    
+    return ss / n
+
+def _values_stdev(values):
+    """ Standard deviation of a 1-D array """
+    return math.sqrt(_values_variance(values))
+
+if numba.config.DISABLE_JIT:
+    # cfuncs cannot be compiled, so generic_filter calls the Python functions
+    _WINDOW_VARIANCE = _values_variance
+    _WINDOW_STDEV = _values_stdev
+else:
+    @cfunc("intc(CPointer(float64), intp, CPointer(float64), voidptr)", cache=True)
+    def _window_variance_cfunc(values_ptr, n, result, user_data):
+        """ generic_filter callback: variance of the values in the footprint """
+        result[0] = _values_variance(carray(values_ptr, (n,)))
+        return 1
+    
+    @cfunc("intc(CPointer(float64), intp, CPointer(float64), voidptr)", cache=True)
+    def _window_stdev_cfunc(values_ptr, n, result, user_data):
+        """ generic_filter callback: standard deviation of the values in the footprint """
+        result[0] = math.sqrt(_values_variance(carray(values_ptr, (n,))))
+        return 1
+    
+    # compiled callbacks let generic_filter run without calling back into Python
+    _WINDOW_VARIANCE = LowLevelCallable(_window_variance_cfunc.ctypes)
+    _WINDOW_STDEV = LowLevelCallable(_window_stdev_cfunc.ctypes)
+
+def _uniform_filter(data, window, output, square=False):
+    """ Moving window mean using separable running sums
+    
+    *Parameters*
+    
+    data : numpy array
+        Array to which filter is applied
+    window : int, tuple or numpy array
+        Size of filter, or a boolean footprint for non-rectangular windows
+    output : numpy array
+        Array into which the result is written. Must not overlap ``data``.
+    square : bool
+        Whether to filter the square of ``data`` instead of ``data``
+        
+    *Returns*
+    
+    array
+        ``output``
+    """
+    footprint = _footprint(window, data.ndim)
+    if _large_footprint(footprint):
+        return _fft_correlate(data, footprint / footprint.sum(), output, square)
+    if footprint is not None:
+        if square:
+            data = np.square(data, dtype=np.float32)
+        return correlate(data, footprint / footprint.sum(), output=output)
+    
+    wy, wx = _window_shape(window)
+    running_box_sum_2d(data, wy, wx, output, square, 1.0 / (wy * wx))
+    
+    return output
+
+def _fft_correlate(data, weights, output, square=False):
+    """ Correlate with a large weights array by overlap-add FFT convolution
+    
+    The data are padded in scipy.ndimage 'reflect' mode and convolved in
+    'valid' mode, so the result matches ``correlate`` at the borders too. The
+    convolution is done in double precision because the squared means are
+    used to compute variances by subtraction.
+    
+    *Parameters*
     
+    data : numpy array
+        Array to which filter is applied
+    weights : numpy array
+        Correlation weights, with the same number of dimensions as ``data``
+    output : numpy array
+        Array into which the result is written
+    square : bool
+        Whether to filter the square of ``data`` instead of ``data``
+        
+    *Returns*
+    
+    array
+        ``output``
+    """
+    a = data.astype(np.float64)
+    if square:
+        np.square(a, out=a)
+    a = np.pad(a, [(k // 2, k - 1 - k // 2) for k in weights.shape], mode='symmetric')
+    output[...] = oaconvolve(a, weights[..., ::-1, ::-1], mode='valid', axes=(-2, -1))
+    
+    return output
+
+def _large_footprint(footprint):
+    """ Whether a footprint is large enough to be filtered by FFT """
+    return footprint is not None and max(footprint.shape[-2:]) >= _FFT_WINDOW
+
+def _window_mean_var(data, window, mean, var):
+    """ Moving window mean and variance written into caller-provided arrays
+    
+    The square of ``data`` is accumulated directly in ``var`` so that no other
+    full-image temporaries are needed.
+    
+    *Parameters*
+    
+    data : numpy array
+        Array to which filter is applied
+    window : int or tuple
+        Size of filter
+    mean : numpy array
+        Array into which the moving window mean is written
+    var : numpy array
+        Array into which the moving window variance is written
+    """
+    _uniform_filter(data, window, mean)
+    _uniform_filter(data, window, var, square=True)
+    
+    np.subtract(var, np.square(mean), out=var)
+    np.maximum(var, 0, out=var)
+
+# smallest footprint side filtered by FFT convolution rather than directly;
+# rectangular windows always use running sums, whose cost does not grow with
+# the window
+_FFT_WINDOW = 25
+
+# size of the tiles filtered at once by _tiled_apply
+_TILE = 512
+
+# number of rows handled by each parallel task in the box sum kernels
+_BOX_CHUNK = 64
+
+@njit(cache=True)
+def _reflect_index(k, n):
+    """ Map index k into [0, n) following scipy.ndimage 'reflect' mode """
+    k = k % (2 * n)
+    if k >= n:
+        k = 2 * n - 1 - k
+    return k
+
+@njit(parallel=True, nogil=True, cache=True)
+def _box_sum_cols(a, w, square, out):
+    """ Sum of w vertically adjacent values of a (or a**2) written to out
+    
+    a and out are stacks of 2-D arrays with shape (bands, rows, columns).
+    """
+    B, H, W = a.shape
+    h = w // 2
+    n_chunks = (H + _BOX_CHUNK - 1) // _BOX_CHUNK
+    for t in prange(B * n_chunks):
+        b = t // n_chunks
+        i0 = (t % n_chunks) * _BOX_CHUNK
+        i1 = min(H, i0 + _BOX_CHUNK)
+        acc = np.zeros(W, dtype=np.float64)
+        
+        # initialize running sum with the window of the first row in chunk
+        for k in range(w - 1):
+            r = _reflect_index(i0 - h + k, H)
+            for j in range(W):
+                v = np.float64(a[b, r, j])
+                acc[j] += v * v if square else v
+        
+        for i in range(i0, i1):
+            add = _reflect_index(i - h + w - 1, H)
+            sub = _reflect_index(i - h, H)
+            for j in range(W):
+                v = np.float64(a[b, add, j])
+                acc[j] += v * v if square else v
+                out[b, i, j] = acc[j]
+                v = np.float64(a[b, sub, j])
+                acc[j] -= v * v if square else v
+
+@njit(parallel=True, nogil=True, cache=True)
+def _box_sum_rows(a, w, scale, out):
+    """ Sum of w horizontally adjacent values of a times scale written to out
+    
+    a and out are stacks of 2-D arrays with shape (bands, rows, columns). Each
+    row is buffered before it is written so a and out may be the same array.
+    """
+    B, H, W = a.shape
+    h = w // 2
+    n_chunks = (H + _BOX_CHUNK - 1) // _BOX_CHUNK
+    for t in prange(B * n_chunks):
+        b = t // n_chunks
+        i0 = (t % n_chunks) * _BOX_CHUNK
+        buf = np.empty(W + w - 1, dtype=np.float64)
+        for i in range(i0, min(H, i0 + _BOX_CHUNK)):
+            for k in range(W + w - 1):
+                buf[k] = a[b, i, _reflect_index(k - h, W)]
+            
+            acc = 0.0
+            for k in range(w - 1):
+                acc += buf[k]
+            for j in range(W):
+                acc += buf[j + w - 1]
+                out[b, i, j] = acc * scale
+                acc -= buf[j]
+
+def running_box_sum_2d(a, wy, wx, out, square=False, scale=1.0):
+    """ Moving window (box) sum of a 2-D array using running sums
+    
+    When JIT compilation is disabled, the ahead-of-time compiled kernels (see
+    _filters_aot.py) are used if they have been built.
+    A 3-D stack of arrays (bands, rows, columns) is filtered band by band in a
+    single call.
+    
+    Boundaries are handled as in scipy.ndimage.uniform_filter ('reflect' mode),
+    so ``running_box_sum_2d(a, w, w, out, scale=1/w**2)`` matches
+    ``uniform_filter(a, w)``.
+    
+    *Parameters*
+    
+    a : numpy array
+        2-D (or 3-D) array to which filter is applied
+    wy, wx : int
+        Number of rows and columns in the window
+    out : numpy array
+        Array into which the result is written. Must not overlap ``a``.
+    square : bool
+        Whether to sum the square of ``a`` instead of ``a``
+    scale : float
+        Factor applied to the sums (e.g. ``1/(wy*wx)`` for a moving mean)
+    
+    *Returns*
+    
+    array
+        ``out``
+    """
+    a3, out3 = _as_stack(a), _as_stack(out)
+    if _filters_native is not None and a.dtype == np.float32 and out.dtype == np.float32:
+        _filters_native.box_sum_cols(a3, wy, square, out3)
+        _filters_native.box_sum_rows(out3, wx, scale, out3)
+        return out
+    
+    _box_sum_cols(a3, wy, square, out3)
+    _box_sum_rows(out3, wx, scale, out3)
+    
+    return out
+
+def _as_stack(a):
+    """ View a 2-D array as a stack of one band """
+    return a[np.newaxis] if a.ndim == 2 else a
+
+def _tiled_apply(img, fn, window, tile=_TILE, out=None):
+    """ Apply a moving window filter to a 2-D array one tile at a time
+    
+    Each tile is extended by a halo of half the window size so that the
+    filtered tiles stitch together seamlessly; at the edges of ``img`` the
+    filter's own boundary handling applies, as it would for the whole array.
+    Keeping tiles small means the filter's temporaries stay cache-resident.
+    
+    *Parameters*
+    
+    img : numpy array
+        2-D array, or 3-D stack of bands, to which filter is applied
+    fn : callable
+        Filter which takes an array like ``img`` and an ``out`` array of the
+        same shape into which the filtered array is written. If it also takes
+        ``mean_out`` or ``variance_out`` scratch arrays, these are allocated
+        once and reused for every tile.
+    window : int or tuple
+        Size of filter
+    tile : int
+        Size of (square) tiles, excluding the halo
+    out : numpy array, optional
+        float32 array into which the result is written
+    
+    *Returns*
+    
+    array
+        filtered array (float32)
+    """
+    H, W = img.shape[-2:]
+    hy, hx = [w // 2 for w in _window_shape(window)]
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    
+    if H <= tile and W <= tile:
+        fn(img, out=out)
+        return out
+    
+    # tiles are filtered into a single scratch buffer, then the inner region is copied
+    scratch = np.empty(img.shape[:-2] + (min(H, tile + 2 * hy), min(W, tile + 2 * hx)),
+                       dtype=np.float32)
+    params = inspect.signature(fn).parameters
+    buffers = {name: np.empty_like(scratch) for name in ('mean_out', 'variance_out')
+               if name in params}
+    
+    for i in range(0, H, tile):
+        i0, i1 = max(i - hy, 0), min(i + tile + hy, H)
+        for j in range(0, W, tile):
+            j0, j1 = max(j - hx, 0), min(j + tile + hx, W)
+            
+            region = (Ellipsis, slice(i1 - i0), slice(j1 - j0))
+            filtered = fn(img[..., i0:i1, j0:j1], out=scratch[region],
+                          **{name: b[region] for name, b in buffers.items()})
+            inner = out[..., i:i + tile, j:j + tile]
+            inner[:] = filtered[..., i - i0:i - i0 + inner.shape[-2],
+                                j - j0:j - j0 + inner.shape[-1]]
+    
+    return out
+
 def filter_image(img, output=None, filter='lee', **kwargs):
     '''
     *Parameters*
@@ -211,6 +681,8 @@ def filter_image(img, output=None, filter='lee', **kwargs):
     output : str 
         Path to output file. If none, overwrites input file
     
+    The image is streamed through the filter in strips, so it never needs to
+    fit in memory.
     '''
     # select filter
     filter = {'lee': lee_filter,
@@ -226,25 +698,118 @@ def filter_image(img, output=None, filter='lee', **kwargs):
     
     img = gdal.Open(file, access)
     '''
-    # read data, ensuring 3-dimensional array shape
-    arr = img.ReadAsArray()
-    if len(arr.shape) == 2:
-        arr = arr[np.newaxis, :, :]
-    
     # Create output file if specified
     if output is None:
         out = img
     else:
         out = cloneRaster(img, output)
         
-    # filter
-    for band_i in range(0, img.RasterCount):
-        print("band: {}".format(band_i + 1))
-        # create filtered data and write to file
-        filtered = filter(arr[band_i, :, :], **kwargs)
-        out.GetRasterBand(band_i + 1).WriteArray(filtered)
+    kwargs.setdefault('window', inspect.signature(filter).parameters['window'].default)
+    hy = _window_shape(kwargs['window'])[0] // 2
+    
+    n_bands, H, W = img.RasterCount, img.RasterYSize, img.RasterXSize
+    rows = _strip_rows(img.GetRasterBand(1))
+    
+    band_kwargs = [dict(kwargs) for band_i in range(n_bands)]
+    if filter is lee_filter and 'overall_variance' not in kwargs:
+        # strips need the variance of the whole band, not their own
+        for band_i in range(n_bands):
+            band_kwargs[band_i]['overall_variance'] = band_variance(
+                img.GetRasterBand(band_i + 1), rows)
+        stack_kwargs = dict(kwargs, overall_variance=np.array(
+            [k['overall_variance'] for k in band_kwargs], dtype=np.float32)[:, None, None])
+    else:
+        stack_kwargs = kwargs
+    
+    # Small images are filtered with a single call for all bands; otherwise each
+    # band is filtered in its own thread
+    stacked = n_bands > 1 and H * W <= _TILE ** 2
+    stack_filter = partial(filter, **stack_kwargs)
+    band_filters = [partial(filter, **k) for k in band_kwargs]
+    
+    def write_strip(y, strip):
+        for band_i, filtered in enumerate(strip):
+            out.GetRasterBand(band_i + 1).WriteArray(filtered, 0, y)
+    
+    # Strips are read into, and filtered into, buffers allocated once. In-place
+    # filtering alternates between two output buffers (see below).
+    strip_shape = (n_bands, min(rows + 2 * hy, H), W)
+    in_buf = np.empty(strip_shape, dtype=np.float32)
+    out_bufs = [np.empty(strip_shape, dtype=np.float32) for _ in range(1 if out is not img else 2)]
+    
+    # let GDAL cache the blocks touched by two strips (with their halos) so halo
+    # rows are not re-read from disk
+    by = img.GetRasterBand(1).GetBlockSize()[1]
+    block_rows = min(by * (-(-(rows + 2 * hy) // by) + 1), H)
+    itemsize = gdal.GetDataTypeSize(img.GetRasterBand(1).DataType) // 8
+    cache_max = gdal.GetCacheMax()
+    gdal.SetCacheMax(max(cache_max, 2 * n_bands * block_rows * W * itemsize))
+    
+    # Read, filter and write the image in strips of whole rows, each extended
+    # by a halo so that strips stitch together seamlessly. When filtering in
+    # place, a strip is only written once the next strip (whose halo overlaps
+    # it) has been read.
+    pending = None
+    if stacked or n_bands == 1 or not _concurrent_kernels():
+        n_workers = 1
+    else:
+        n_workers = min(n_bands, os.cpu_count() or 1)
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as ex:
+            for k, y in enumerate(range(0, H, rows)):
+                print("rows: {}-{}".format(y + 1, min(y + rows, H)))
+                y0, y1 = max(y - hy, 0), min(y + rows + hy, H)
+                inner = slice(y - y0, y - y0 + min(rows, H - y))
+                tiles = in_buf[:, :y1 - y0]
+                filtered = out_bufs[k % len(out_bufs)][:, :y1 - y0]
+                
+                for band_i in range(n_bands):
+                    img.GetRasterBand(band_i + 1).ReadAsArray(0, y0, W, y1 - y0,
+                                                              buf_obj=tiles[band_i])
+                
+                if stacked:
+                    strip = _tiled_apply(tiles, stack_filter, kwargs['window'],
+                                         out=filtered)[:, inner]
+                else:
+                    # filter bands concurrently if the threading layer allows
+                    # it (the filter kernels release the GIL)
+                    strip = list(ex.map(
+                        lambda b: _tiled_apply(tiles[b], band_filters[b], kwargs['window'],
+                                               out=filtered[b])[inner],
+                        range(n_bands)))
+                
+                if out is not img:
+                    write_strip(y, strip)
+                else:
+                    if pending is not None:
+                        write_strip(*pending)
+                    pending = (y, strip)
+            
+            if pending is not None:
+                write_strip(*pending)
+    finally:
+        gdal.SetCacheMax(cache_max)
         
     # close dataset(s)
     out.FlushCache() # TODO: should this be called for each band?
     del out, img
+
+def _concurrent_kernels():
+    """ Whether parallel kernels may be launched from several threads at once
     
+    Numba only selects a threading layer when the first parallel kernel is
+    launched, so a small kernel is run first. The workqueue layer, used when
+    neither TBB nor OpenMP is available, is not threadsafe.
+    """
+    _nonzero_moments(np.zeros((1, 1), dtype=np.float32))
+    return numba.threading_layer() != 'workqueue'
+
+def _strip_rows(band, tile=_TILE):
+    """ Number of rows per strip when streaming a band
+    
+    The smallest multiple of the band's block height of at least ``tile`` rows,
+    so that reads are aligned to GDAL blocks. Bands with blocks taller than
+    ``tile`` (e.g. single-strip files) are streamed one block at a time.
+    """
+    by = band.GetBlockSize()[1]
+    return by * -(-tile // by)
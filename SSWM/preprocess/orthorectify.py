@@ -1,6 +1,9 @@
 from osgeo import gdal
 import os
 import subprocess
+
+# use all cores for compression and other multithreaded GDAL operations
+gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
     
 def orthorectify_dem_rpc(input, output, DEM, dtype=None):
     """ Orthorectify raster using rational polynomial coefficients and a DEM
@@ -24,13 +27,19 @@ def orthorectify_dem_rpc(input, output, DEM, dtype=None):
     
     if dtype is None:
         dtype =  max([input.GetRasterBand(i + 1).DataType for i in range(input.RasterCount)])
+    
+    # floating point predictor for float data, horizontal differencing otherwise
+    predictor = 3 if dtype in (gdal.GDT_Float32, gdal.GDT_Float64) else 2
       
     # set warp options
     optns = gdal.WarpOptions(
                 transformerOptions = ["RPC_DEM={}".format(DEM)],
-                creationOptions = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"],
+                creationOptions = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+                                   "NUM_THREADS=ALL_CPUS", "COMPRESS=ZSTD", "ZSTD_LEVEL=1",
+                                   "PREDICTOR={}".format(predictor)],
                 rpc = True,
                 multithread=True,
+                warpMemoryLimit=2 * 1024**3,
                 outputType=dtype,
                 resampleAlg='cubic')
     
@@ -53,32 +62,81 @@ def orthorectify_otb(input, output, DEMFolder, gridspacingx, ram=1000):
         Path to DEM
     gridspacing : float
         pixel size of deformation grid used for the ortho
+    ram : int
+        Available memory for processing (in MB)
 
     Returns
     -------
+    int
+        Return code of otbcli_OrthoRectification
     """
+    return orthorectify_otb_batch([input], [output], DEMFolder, gridspacingx, ram=ram)[0]
+
+
+def orthorectify_otb_batch(inputs, outputs, DEMFolder, gridspacingx, ram=None):
+    """ Orthorectify several rasters concurrently using orfeotoolbox Ortho
+
+    One otbcli_OrthoRectification process is launched per input and the
+    available cores are divided between them.
 
-    command = '''otbcli_OrthoRectification -io.in {} -io.out {} -map wgs -elev.dem {} -interpolator linear -opt.ram {} -opt.gridspacing {}'''.format(
-        str(input), str(output), str(DEMFolder), str(ram), str(gridspacingx))
+    Parameters
+    ----------
+    inputs : list of str
+        Paths to images to orthorectify
+    outputs : list of str
+        Paths to output images, one for each input
+    DEM : str
+        Path to DEM
+    gridspacing : float
+        pixel size of deformation grid used for the ortho
+    ram : int, optional
+        Available memory for each process (in MB). If not provided, half of the
+        currently available memory is divided between the processes.
 
-    print(command)
-    '''
-    print(command)
+    Returns
+    -------
+    list of int
+        Return codes of each process
+    """
+    if len(inputs) != len(outputs) or not inputs:
+        raise ValueError("inputs and outputs must be non-empty lists of equal length")
 
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, shell=True)  # text=True decodes output to string
+    if ram is None:
+        ram = max(1, _available_ram() // (2 * len(inputs)))
 
-    while True:
-        line = p.stdout.readline()
-        if not line:
-            break  # No more output, subprocess finished
+    threads = str(max(1, (os.cpu_count() or 1) // len(inputs)))
+    env = dict(os.environ, OMP_NUM_THREADS=threads, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=threads)
 
-        # Process the line to extract and print progress
-        print(f"Subprocess output: {line.strip()}")
+    procs = []
+    for input, output in zip(inputs, outputs):
+        command = ['otbcli_OrthoRectification',
+                   '-io.in', str(input),
+                   '-io.out', str(output),
+                   '-map', 'wgs',
+                   '-elev.dem', str(DEMFolder),
+                   '-interpolator', 'linear',
+                   '-opt.ram', str(ram),
+                   '-opt.gridspacing', str(gridspacingx)]
+        print(' '.join(command))
+        # output is not piped so that a verbose process can never block on a full pipe
+        procs.append(subprocess.Popen(command, env=env))
 
-    p.wait()  # Wait for the subprocess to fully terminate
-    '''
-    ok = os.system(command)
-    #print("Command result: {}".format(p.returncode))
+    ok = [p.wait() for p in procs]
     print(ok)
-    
 
+    return ok
+
+
+def _available_ram(default=1000):
+    """ Currently available memory (in MB), or ``default`` if it cannot be determined """
+    try:
+        import psutil
+        return psutil.virtual_memory().available // 1024**2
+    except ImportError:
+        pass
+
+    # os.sysconf does not exist on Windows and macOS lacks SC_AVPHYS_PAGES
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 1024**2
+    except (AttributeError, ValueError, OSError):
+        return default
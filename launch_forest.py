@@ -4,6 +4,7 @@ forest clasifier and then classify the image
 """
 
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import shutil
@@ -98,7 +99,18 @@ def forestClassifier(config, archive):
         failure(exdir)
  
     RF.rf.num_procs = num_procs
-    RF.save_evaluation(output_report)
+    
+    # Evaluate the model while the image is classified; the report is not
+    # needed until postprocessing
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        evaluation = ex.submit(RF.save_evaluation, output_report)
+        
+        # Classify image
+        #================
+        output_img = output_basename + '.tif'
+        RF.predict_chunked(cur_file, output_img, CHUNK_SIZE)
+        
+        evaluation.result()
     
     if RF.results['m']['F1'] < bandnames.MIN_F1:
         msg = ("Poor classification quality found during model fitting"
@@ -106,11 +118,6 @@ def forestClassifier(config, archive):
                 "Classification for this image was not performed. Change F1 threshold in the "
                 "'bandnames' class (utils.py)".format(bandnames.MIN_F1))
         logging.error(msg)
-        
-    # Classify image
-    #================
-    output_img = output_basename + '.tif'
-    RF.predict_chunked(cur_file, output_img, CHUNK_SIZE)
 
     del RF
     # Postprocess to remove false positives